@@ -1,9 +1,16 @@
+import glob
+import hashlib
+import io
+import os
+import urllib.request
 import streamlit as st
 import geopandas as gpd
 import folium
 from streamlit_folium import st_folium
-from folium.plugins import MeasureControl, Draw
+from folium.plugins import MeasureControl, Draw, VectorGridProtobuf
 import pandas as pd
+import numpy as np
+import shapely
 
 # =========================================================
 # APP CONFIG
@@ -27,6 +34,7 @@ if "auth_ok" not in st.session_state:
     st.session_state.username = None
     st.session_state.user_role = None
     st.session_state.points_gdf = None
+    st.session_state.point_se = None
     st.session_state.query_result = None
 
 # =========================================================
@@ -58,9 +66,25 @@ if not st.session_state.auth_ok:
 # =========================================================
 SE_URL = "https://raw.githubusercontent.com/Moccamara/emop2026/master/Suivi_emop/data/emop2026.geojson"
 
-@st.cache_data(show_spinner=False)
-def load_se_data(url):
-    gdf = gpd.read_file(url)
+# Attributes used by the app (normalized names: lowercase, stripped)
+SE_COLUMNS = ["lregion", "lcerde", "lcommune", "region", "cercle", "commune", "num_se", "pop_se"]
+
+# Local GeoParquet copies of the processed SE layer, one per source revision,
+# in a directory of their own (everything in it may be replaced).
+# Bump SE_CACHE_VERSION whenever the output of read_se_geojson changes.
+SE_CACHE_DIR = "Suivi_emop/.cache"
+SE_CACHE_VERSION = 2
+
+# Optional vector tiles for the SE layer, prebuilt at deploy time with e.g.
+#   tippecanoe -o se.mbtiles -l se --minimum-zoom=8 --maximum-zoom=18 emop2026.geojson
+# and served from .../{z}/{x}/{y}.pbf. When unset, the map embeds the SE GeoJSON.
+SE_TILES_URL = os.environ.get("SE_TILES_URL")
+SE_TILES_LAYER = "se"
+
+def read_se_geojson(url):
+    # Single read of the source: a column projection would need the field
+    # names first, i.e. a second full parse of the GeoJSON
+    gdf = gpd.read_file(url, engine="pyogrio", use_arrow=True)
 
     if gdf.crs is None:
         gdf = gdf.set_crs(epsg=4326)
@@ -86,6 +110,9 @@ def load_se_data(url):
     # Remove duplicate columns
     gdf = gdf.loc[:, ~gdf.columns.duplicated()]
 
+    # Keep only the attributes used by the app
+    gdf = gdf[[c for c in gdf.columns if c in SE_COLUMNS] + [gdf.geometry.name]]
+
     # Safety guarantees
     for col in ["region", "cercle", "commune", "num_se"]:
         if col not in gdf.columns:
@@ -93,9 +120,70 @@ def load_se_data(url):
     if "pop_se" not in gdf.columns:
         gdf["pop_se"] = 0
 
+    # Categorical attributes: filters and unique() compare integer codes
+    for col in ["lregion", "lcerde", "lcommune", "region", "cercle", "commune", "num_se"]:
+        gdf[col] = gdf[col].astype("category")
+
     # Remove invalid geometries
     gdf = gdf[gdf.is_valid & ~gdf.is_empty]
 
+    # Per-SE bounds, so map extents are plain numeric min/max
+    gdf = gdf.join(gdf.geometry.bounds)
+
+    return gdf
+
+# Revision of the SE source: ETag/Last-Modified for a URL, mtime for a local
+# file. None when it cannot be determined (the cache is then bypassed).
+def se_source_revision(url):
+    if os.path.exists(url):
+        return str(os.path.getmtime(url))
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.headers.get("ETag") or response.headers.get("Last-Modified")
+    except (OSError, ValueError):
+        return None
+
+# Shared across sessions (no pickling round-trip): callers must not modify it
+@st.cache_resource(show_spinner=False)
+def load_se_data(url):
+    revision = se_source_revision(url)
+    if revision is None:
+        return read_se_geojson(url)
+
+    key = hashlib.sha1(f"{SE_CACHE_VERSION}|{url}|{revision}".encode()).hexdigest()[:16]
+    parquet_path = os.path.join(SE_CACHE_DIR, f"se-{key}.parquet")
+    if os.path.exists(parquet_path):
+        try:
+            cached = gpd.read_parquet(parquet_path)
+        except (OSError, ValueError):  # ValueError covers pyarrow.ArrowInvalid
+            cached = None  # Damaged copy: rebuild it from the GeoJSON
+        # A copy written without a version bump may predate derived columns
+        if cached is not None and {"geometry", "minx", "miny", "maxx", "maxy", *SE_COLUMNS}.issubset(cached.columns):
+            return cached
+
+    gdf = read_se_geojson(url)
+    try:
+        # Write to a temporary name and move it into place, so an interrupted
+        # write never leaves a truncated file under the final name
+        os.makedirs(SE_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, parquet_path)
+        # Drop copies of older revisions/versions and leftover temporary files
+        for stale in glob.glob(os.path.join(SE_CACHE_DIR, "se-*")):
+            if stale != parquet_path:
+                os.remove(stale)
+    except OSError:
+        pass  # No writable cache location: keep reading the GeoJSON
+    return gdf
+
+# Simplified geometries for the map layer only (sub-pixel vertices dropped);
+# spatial queries keep the full-precision polygons
+@st.cache_resource(show_spinner=False)
+def load_se_display(url):
+    gdf = load_se_data(url).copy()
+    gdf["geometry"] = gdf.geometry.simplify(tolerance=1e-5, preserve_topology=True)
     return gdf
 
 try:
@@ -121,25 +209,32 @@ def unique_clean(series):
         series = series.iloc[:, 0]
     return sorted(series.dropna().astype(str).str.strip().unique())
 
+@st.cache_data(show_spinner=False)
+def load_filter_index(url):
+    """Selectbox options and row positions per commune, computed once."""
+    gdf = load_se_data(url)
+    regions = unique_clean(gdf["lregion"])
+    cercles = gdf.groupby("lregion", observed=True)["lcerde"].apply(unique_clean).to_dict()
+    communes = gdf.groupby(["lregion", "lcerde"], observed=True)["lcommune"].apply(unique_clean).to_dict()
+    commune_rows = gdf.groupby(["lregion", "lcerde", "lcommune"], observed=True).indices
+    return regions, cercles, communes, commune_rows
+
+regions, cercles_by_region, communes_by_cercle, rows_by_commune = load_filter_index(SE_URL)
+
 # =========================================================
 # ATTRIBUTE FILTERS
 # =========================================================
 st.sidebar.markdown("### 🗂️ Attribute Query")
 
 # REGION
-regions = unique_clean(gdf["lregion"])
 region = st.sidebar.selectbox("Region", regions)
-gdf_r = gdf[gdf["lregion"] == region]
 
 # CERCLE
-cercles = unique_clean(gdf_r["lcerde"])
-cercle = st.sidebar.selectbox("Cercle", cercles)
-gdf_c = gdf_r[gdf_r["lcerde"] == cercle]
+cercle = st.sidebar.selectbox("Cercle", cercles_by_region.get(region, []))
 
 # COMMUNE
-communes = unique_clean(gdf_c["lcommune"])
-commune = st.sidebar.selectbox("Commune", communes)
-gdf_commune = gdf_c[gdf_c["lcommune"] == commune]
+commune = st.sidebar.selectbox("Commune", communes_by_cercle.get((region, cercle), []))
+gdf_commune = gdf.iloc[rows_by_commune.get((region, cercle, commune), [])]
 
 # SE (num_se)
 se_list = ["No filter"] + unique_clean(gdf_commune["num_se"])
@@ -150,13 +245,16 @@ gdf_se = gdf_commune if se_selected == "No filter" else gdf_commune[gdf_commune[
 # SPATIAL QUERY
 # =========================================================
 st.sidebar.markdown("### 🧭 Spatial Query")
-query_type = st.sidebar.selectbox("Query type", ["Intersects", "Within", "Contains"])
+# Point -> SE predicate, expressed from the SE side (points are the indexed geometries)
+SE_PREDICATES = {"Intersects": "intersects", "Within": "contains", "Contains": "within"}
+query_type = st.sidebar.selectbox("Query type", list(SE_PREDICATES))
 if st.sidebar.button("Run Query"):
     if st.session_state.points_gdf is not None and not gdf_se.empty:
-        pts = st.session_state.points_gdf.to_crs(gdf_se.crs)
-        st.session_state.query_result = gpd.sjoin(
-            pts, gdf_se, predicate=query_type.lower(), how="inner"
-        )
+        pts = st.session_state.points_gdf
+        # Point -> SE pairs are computed at upload: keep those of the selected SE
+        se_labels, pts_idx = st.session_state.point_se[query_type]
+        in_selection = np.isin(se_labels, gdf_se.index)
+        st.session_state.query_result = pts.iloc[np.unique(pts_idx[in_selection])]
         st.sidebar.success(f"{len(st.session_state.query_result)} points found.")
     else:
         st.sidebar.error("No point data available.")
@@ -164,26 +262,53 @@ if st.sidebar.button("Run Query"):
 # =========================================================
 # CSV UPLOAD (ADMIN)
 # =========================================================
+# Points and point -> SE pairs, built once per uploaded file (keyed by its
+# content) and shared across reruns without a pickling round-trip. Only the
+# last few uploads are kept in memory.
+@st.cache_resource(show_spinner=False, max_entries=4)
+def load_points(csv_bytes, se_url):
+    df = pd.read_csv(io.BytesIO(csv_bytes), usecols=lambda c: c in {"Latitude", "Longitude"})
+    if not {"Latitude", "Longitude"}.issubset(df.columns):
+        return None
+
+    # One validity mask and a single vectorized constructor for all points
+    lat = pd.to_numeric(df["Latitude"], errors="coerce").to_numpy()
+    lon = pd.to_numeric(df["Longitude"], errors="coerce").to_numpy()
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    points_gdf = gpd.GeoDataFrame(
+        df.loc[valid].reset_index(drop=True),
+        geometry=shapely.points(lon[valid], lat[valid]),
+        crs="EPSG:4326"
+    )
+    points_sindex = points_gdf.sindex
+
+    # Point -> SE pairs for every query type: all SE polygons against the
+    # points STRtree, evaluated inside GEOS
+    se = load_se_data(se_url)
+    point_se = {}
+    for qt, predicate in SE_PREDICATES.items():
+        se_idx, pts_idx = points_sindex.query(se.geometry, predicate=predicate)
+        point_se[qt] = (se.index.to_numpy()[se_idx], pts_idx)
+
+    return points_gdf, point_se
+
 if st.session_state.user_role == "Admin":
     st.sidebar.markdown("### 📥 Upload CSV Points")
     csv_file = st.sidebar.file_uploader("Upload CSV", type=["csv"])
     if csv_file is not None:
-        df = pd.read_csv(csv_file)
-        if {"Latitude", "Longitude"}.issubset(df.columns):
-            st.session_state.points_gdf = gpd.GeoDataFrame(
-                df,
-                geometry=gpd.points_from_xy(df["Longitude"], df["Latitude"]),
-                crs="EPSG:4326"
-            )
-            st.sidebar.success(f"✅ {len(df)} points loaded")
+        points = load_points(csv_file.getvalue(), SE_URL)
+        if points is not None:
+            st.session_state.points_gdf, st.session_state.point_se = points
+            st.sidebar.success(f"✅ {len(st.session_state.points_gdf)} points loaded")
         else:
             st.sidebar.error("CSV must contain Latitude & Longitude")
 
 # =========================================================
 # MAP (OSM + GOOGLE SATELLITE + Dynamic Legend)
 # =========================================================
-if not gdf_se.empty:
-    minx, miny, maxx, maxy = gdf_se.total_bounds
+def build_base_map(gdf_se, se_selected):
+    minx, miny = gdf_se[["minx", "miny"]].min()
+    maxx, maxy = gdf_se[["maxx", "maxy"]].max()
 
     m = folium.Map(
         location=[(miny + maxy) / 2, (minx + maxx) / 2],
@@ -201,51 +326,135 @@ if not gdf_se.empty:
         control=True
     ).add_to(m)
 
-    # SE polygons
-    folium.GeoJson(
-        gdf_se,
-        name="SE",
-        tooltip=folium.GeoJsonTooltip(
-            fields=["num_se", "pop_se"],
-            aliases=["SE Number", "Population"]
-        ),
-        style_function=lambda x: {
-            "color": "blue",
-            "weight": 2,
-            "fillOpacity": 0.2,
-        },
-    ).add_to(m)
+    # SE polygons: with vector tiles, every SE comes from the tiles and the
+    # GeoJson layers only carry the selection (SE highlight or commune outline)
+    if SE_TILES_URL:
+        VectorGridProtobuf(
+            SE_TILES_URL,
+            name="SE (tiles)",
+            options={
+                "vectorTileLayerStyles": {
+                    SE_TILES_LAYER: {"color": "blue", "weight": 2, "fill": True, "fillOpacity": 0.2},
+                },
+            },
+        ).add_to(m)
+
+    if SE_TILES_URL and se_selected == "No filter":
+        # Commune outline as a single dissolved feature
+        folium.GeoJson(
+            gdf_se[["geometry"]].dissolve(),
+            name="Commune",
+            style_function=lambda x: {
+                "color": "black",
+                "weight": 3,
+                "fill": False,
+            },
+        ).add_to(m)
+    else:
+        if SE_TILES_URL:
+            se_style = {"color": "orange", "weight": 4, "fillOpacity": 0.4}
+        else:
+            se_style = {"color": "blue", "weight": 2, "fillOpacity": 0.2}
+        # Only the tooltip attributes are serialized
+        folium.GeoJson(
+            gdf_se[["num_se", "pop_se", "geometry"]],
+            name="SE",
+            tooltip=folium.GeoJsonTooltip(
+                fields=["num_se", "pop_se"],
+                aliases=["SE Number", "Population"]
+            ),
+            style_function=lambda x: se_style,
+        ).add_to(m)
+
+    # Measure & Draw
+    MeasureControl().add_to(m)
+    Draw(export=True).add_to(m)
+
+    # Fit bounds
+    m.fit_bounds([[miny, minx], [maxy, maxx]])
 
-    # CRS check & points plotting
-    if st.session_state.points_gdf is not None:
-        st.session_state.points_gdf = st.session_state.points_gdf.to_crs(gdf_se.crs)
+    return m
+
+# Children of every element in a folium/branca element tree
+def snapshot_children(element):
+    snapshot = [(element, element._children.copy())]
+    for child in element._children.values():
+        snapshot += snapshot_children(child)
+    return snapshot
+
+# Number of elements in a folium/branca element tree
+def count_elements(element):
+    return sum(1 + count_elements(child) for child in element._children.values())
+
+# Points layer data built from the raw coordinate array (one vectorized call)
+# rather than geopandas' per-geometry __geo_interface__
+def points_geojson(points):
+    xy = shapely.get_coordinates(points.geometry.values)
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": c}, "properties": {}}
+            for c in xy.tolist()
+        ],
+    }
 
+if not gdf_se.empty:
+    # The base map only depends on the attribute filters: build it only when
+    # they change, not on every rerun (login, draws, query...). st_folium still
+    # renders it to HTML on each rerun, but the folium objects, including the
+    # SE GeoJson conversion, are not rebuilt.
+    map_key = (region, cercle, commune, se_selected)
+    if st.session_state.get("map_key") != map_key:
+        st.session_state.base_map = build_base_map(load_se_display(SE_URL).loc[gdf_se.index], se_selected)
+        st.session_state.map_key = map_key
+    m = st.session_state.base_map
+
+    # Points are built in EPSG:4326, the CRS load_se_data guarantees for SE
     points_to_show = st.session_state.query_result if st.session_state.query_result is not None else st.session_state.points_gdf
 
     # Add points (concession) and legend
+    # Custom FeatureGroup for legend
+    concessions_group = folium.FeatureGroup(name="Concession")
     if points_to_show is not None and not points_to_show.empty:
-        # Custom FeatureGroup for legend
-        concessions_group = folium.FeatureGroup(name="Concession")
-        for _, r in points_to_show.iterrows():
-            folium.CircleMarker(
-                location=[r.geometry.y, r.geometry.x],
+        # One GeoJson layer for all points instead of one marker object per point
+        folium.GeoJson(
+            points_geojson(points_to_show),
+            marker=folium.CircleMarker(
                 radius=4,
                 color="red",
                 fill=True,
                 fill_opacity=0.7
-            ).add_to(concessions_group)
-        concessions_group.add_to(m)
-
-    # Measure & Draw
-    MeasureControl().add_to(m)
-    Draw(export=True).add_to(m)
-    folium.LayerControl(collapsed=False).add_to(m)
-
-    # Fit bounds
-    m.fit_bounds([[miny, minx], [maxy, maxx]])
-
-    # Display map
-    st_folium(m, height=550, use_container_width=True)
+            ),
+        ).add_to(concessions_group)
+    layer_control = folium.LayerControl(collapsed=False)
+
+    # Display map (points and layer control are added dynamically on top of the base map).
+    # st_folium mutates the map it renders: it attaches the dynamic layers
+    # (add_to), and every render appends elements to the root Figure's
+    # header/html/script and to some layers. Snapshot the children of every
+    # element and restore them, even on error, so the cached base map stays
+    # the same across reruns. branca has no public API to remove child elements.
+    root = m.get_root()
+    trees = [root, root.header, root.html, root.script]
+    snapshot = [entry for tree in trees for entry in snapshot_children(tree)]
+    size_before = sum(count_elements(tree) for tree in trees)
+    try:
+        st_folium(
+            m,
+            height=550,
+            use_container_width=True,
+            feature_group_to_add=concessions_group,
+            layer_control=layer_control,
+        )
+    finally:
+        for element, children in snapshot:
+            element._children.clear()
+            element._children.update(children)
+
+    # Should the render still have grown the map elsewhere, drop the cached
+    # copy so the next rerun rebuilds it instead of growing it further
+    if sum(count_elements(tree) for tree in trees) != size_before:
+        st.session_state.map_key = None
 
 # =========================================================
 # FOOTER